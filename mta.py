@@ -6,17 +6,189 @@ Iftach Haitner, Nikolaos Makriyannis, Samuel Ranellucci and Eliad Tsfadia,
 Eurocrypt 2021.
 """
 
-from sage.misc.prandom import randrange
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+from sage.misc.prandom import getrandbits, randrange
+from sage.misc.randstate import current_randstate, set_random_seed
 
 # This global is used to set the security parameter: k implies k/4 bits of statistical security.
 k = 512
 
+# This generator is used for all of the vector sampling (see get_rng). Like Sage's randrange,
+# it makes no cryptographic guarantees. rng_state is the Sage random state that rng was seeded from.
+rng = None
+rng_state = None
+
+
+def fits_int64(q, n):
+    """
+    fits_int64. This function returns True if an inner product of two length-n vectors over
+    Z_q can be accumulated in a signed 64-bit integer without overflowing. If this holds then
+    we can store all of the vectors in the protocol as NumPy int64 arrays; otherwise we fall
+    back to arrays of (arbitrary precision) Python integers.
+
+    ::
+
+    >>> fits_int64(2**16 + 1, 529)
+    True
+    >>> fits_int64(2**61 - 1, 573)
+    False
+    """
+    return n * (q - 1) ** 2 < 2**63
+
+
+def play_kernel(a, b, q, delta, t, v, rnd):
+    """
+    play_kernel. This function runs the whole protocol in a single pass over the vectors.
+    Here v and rnd are the values sampled by Receiver.sample_v, before v[rnd] is adjusted so that
+    <v, t> = b. In other words, this function returns (p1, p2) where p1 = -<delta, v'> mod q and
+    p2 = <z, v'> mod q, where v' = Receiver.v() and z[i] = a * t[i] + delta[i] mod q is the output
+    of the i-th OT.
+
+    This works by accumulating <t, v>, <delta, v> and <z, v> together, and then correcting all
+    three for the adjusted entry at the end.
+    All inputs must be int64 values that satisfy fits_int64(q, len(delta)).
+
+    If mta_core.pyx has been built then this function is replaced by the Cython version. Otherwise,
+    if Numba is installed then this function is JIT compiled. If neither is available then play uses
+    NumPy directly and this function is only kept for reference.
+
+    ::
+
+    >>> q = 11
+    >>> delta = np.asarray([1, 2, 3], dtype=np.int64)
+    >>> t = np.asarray([1, -1, 1], dtype=np.int64)
+    >>> v = np.asarray([4, 5, 6], dtype=np.int64)
+    >>> play_kernel(7, 7, q, delta, t, v, 1) == (-(1*4 + 2*3 + 3*6) % q, (8*4 + 6*3 + 10*6) % q)
+    True
+    """
+    tot = 0
+    p1 = 0
+    p2 = 0
+    for i in range(len(delta)):
+        z = (a * t[i] + delta[i]) % q
+        tot += t[i] * v[i]
+        p1 += delta[i] * v[i]
+        p2 += z * v[i]
+
+    # Now work out what v[rnd] should have been (see Receiver.v) and correct for it.
+    rest = tot - t[rnd] * v[rnd]
+    diff = ((b - rest) * t[rnd]) % q - v[rnd]
+    z = (a * t[rnd] + delta[rnd]) % q
+    p1 = (p1 % q + delta[rnd] * diff) % q
+    p2 = (p2 % q + z * diff) % q
+    return (-p1) % q, p2
+
+
+# This records whether play_kernel is compiled, and so whether play should use it.
+# We prefer the Cython version (see mta_core.pyx) if it has been built, and then Numba.
+# Numba is only imported if the Cython version isn't available.
+try:
+    from mta_core import play_kernel
+
+    kernel_compiled = True
+except ImportError:
+    try:
+        from numba import njit
+
+        play_kernel = njit(cache=True, fastmath=False)(play_kernel)
+        kernel_compiled = True
+    except ImportError:
+        kernel_compiled = False
+
+
+# These are used by is_prime_cached to rule out composites before carrying out a full primality test.
+small_primes = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31)
+
+
+@lru_cache(maxsize=128)
+def is_prime_cached(q):
+    """
+    is_prime_cached. This function returns True if q is prime and False otherwise.
+    The results are cached, as the same q is typically used to construct many players.
+    Before using Sage's primality test we try dividing by some small primes, as this quickly
+    rules out most composite q.
+
+    ::
+
+    >>> is_prime_cached(2**16 + 1)
+    True
+    >>> is_prime_cached(4)
+    False
+    >>> [q for q in range(-1, 40) if is_prime_cached(q)]
+    [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37]
+    >>> is_prime_cached(37 * 41)
+    False
+    """
+    if q < 2:
+        return False
+    for p in small_primes:
+        if q == p:
+            return True
+        if q % p == 0:
+            return False
+    return bool(ZZ(q).is_prime())
+
+
+def get_rng():
+    """
+    get_rng. This function returns the NumPy generator used for sampling vectors.
+    The generator is seeded from Sage's current random state, and is re-seeded whenever that state
+    changes. This means that calling set_random_seed makes the whole protocol reproducible, just as
+    it does for Sage's randrange.
+
+    ::
+
+    >>> set_random_seed(42)
+    >>> x = get_rng().integers(0, 2**32, size=4).tolist()
+    >>> set_random_seed(42)
+    >>> x == get_rng().integers(0, 2**32, size=4).tolist()
+    True
+    """
+    global rng, rng_state
+    # set_random_seed always installs a new state object, even if the seed is the same.
+    state = current_randstate()
+    if state is not rng_state:
+        rng = np.random.default_rng(int(state.seed()))
+        rng_state = state
+    return rng
+
+
+def sample_vector(q, n, dtype):
+    """
+    sample_vector. This function returns an array of n elements chosen uniformly at random over Z_q.
+    If dtype is np.int64 then the whole array is sampled in a single call to get_rng(). Otherwise q is
+    too large for int64 and we sample each element individually using Sage's randrange.
+
+    ::
+
+    >>> q = 11
+    >>> v = sample_vector(q, 100, np.int64)
+    >>> len(v)
+    100
+    >>> [x for x in v if x < 0 or x >= q]
+    []
+    >>> q = 2**61 - 1
+    >>> v = sample_vector(q, 100, object)
+    >>> len(v)
+    100
+    >>> [x for x in v if x < 0 or x >= q]
+    []
+    """
+    if dtype is np.int64:
+        return get_rng().integers(0, int(q), size=n, dtype=np.int64)
+    return np.asarray([randrange(q) for t in range(n)], dtype=object)
+
 
 def sample_t():
     """
     sample_t. This function returns either 1 or -1. The value returned is generated uniformly randomly.
     Note that this version of this function does not make any strong randomness guarantees: we simply use
-    Sage's randrange function for this. 
+    Sage's getrandbits function for this. Callers that need cryptographic randomness should replace this
+    function.
 
     ::
 
@@ -25,11 +197,7 @@ def sample_t():
     []
     """
 
-    # There's probably a much better way to write this.
-    if randrange(100) % 2 == True:
-        return 1
-    else:
-        return -1
+    return 1 if getrandbits(1) else -1
 
 
 class Player:
@@ -61,14 +229,20 @@ class Player:
         ...
         ValueError: secret should be smaller than q
         """
-        if ZZ(q).is_prime() == False:
+        if not is_prime_cached(int(q)):
             raise ValueError("q must be prime")
         if secret >= q:
             raise ValueError("secret should be smaller than q")
 
-        self.secret = secret
-        self.q_ = q
-        self.n_ = ceil(log(q, 2)) + k
+        # We store these as Python ints: this avoids Sage's coercion machinery in the
+        # arithmetic below. Use sage_q if you need q as a Sage Integer.
+        self.secret = int(secret)
+        self.q_ = q = int(q)
+        # For prime q > 2 the bit length of q is exactly ceil(log(q, 2)), and computing it
+        # avoids going through the symbolic ring.
+        self.n_ = q.bit_length() + k
+        # All vectors held by this player are stored using this dtype.
+        self.dtype_ = np.int64 if fits_int64(q, self.n_) else object
 
     @property
     def q(self):
@@ -87,17 +261,35 @@ class Player:
         """
         return self.q_
 
+    @property
+    def sage_q(self):
+        """
+        sage_q. This function returns the player's q as a Sage Integer.
+
+        ::
+
+        >>> a = 10
+        >>> q = 11
+        >>> s = Player(a, q)
+        >>> s.sage_q == q and s.sage_q.parent() is ZZ
+        True
+
+        """
+        return ZZ(self.q_)
+
     @property
     def n(self):
         """
         n. This returns the player's n.
-        Here n is the number of OT queries to carry out, computed as ceil(log(q, 2)) + k.
+        Here n is the number of OT queries to carry out, computed as int(q).bit_length() + k.
+        For every prime q > 2 this is the same as ceil(log(q, 2)) + k. For q = 2 this gives
+        2 + k rather than 1 + k, which just means that we carry out one extra OT.
 
         ::
         >>> a = 10
         >>> q = 11
         >>> s = Player(a, q)
-        >>> s.n == ceil(log(q, 2)) + k
+        >>> s.n == int(q).bit_length() + k
         True
 
         """
@@ -125,18 +317,20 @@ class Sender(Player):
         >>> a = 10
         >>> q = 11
         >>> s = Sender(a, q)
-        >>> len(s.delta) == ceil(log(q, 2)) + k
+        >>> len(s.delta) == int(q).bit_length() + k
         True
 
         """
         Player.__init__(self, a, q)
-        self.delta_ = [randrange(q) for t in range(self.n)]
+        # delta is stored as a single contiguous buffer that can't be modified after construction.
+        self.delta_ = np.ascontiguousarray(sample_vector(q, self.n, self.dtype_))
+        self.delta_.setflags(write=False)
 
     @property
     def delta(self):
         """
         delta. This function returns the sender's delta object.
-        Here delta is a list of n elements chosen uniformly at
+        Here delta is a read-only array of n elements chosen uniformly at
         random over Z_q.
 
         ::
@@ -144,10 +338,12 @@ class Sender(Player):
         >>> a = 10
         >>> q = 11
         >>> s = Sender(a, q)
-        >>> len(s.delta) == ceil(log(a, 2)) + k
+        >>> len(s.delta) == int(q).bit_length() + k
         True
         >>> [x for x in s.delta if x >= q]
         []
+        >>> s.delta.flags.writeable
+        False
 
         """
         return self.delta_
@@ -176,19 +372,68 @@ class Sender(Player):
         Traceback (most recent call last):
         ...
         ValueError: i is out of range
-        >>> s.ot(0, 1) == (a + s.delta[0]) % q
+        >>> s.ot(0, 1) == int(a + s.delta[0]) % q
         True
-        >>> s.ot(0, -1) == (s.delta[0] - a) % q
+        >>> s.ot(0, -1) == int(s.delta[0] - a) % q
         True
         """
 
-        if i >= len(self.delta):
+        if i >= len(self.delta_):
             raise ValueError("i is out of range")
         if t != 1 and t != -1:
             raise ValueError("t must be 1 or -1")
 
         # All operations are over Z_q.
-        return (self.secret * t + self.delta[i]) % self.q
+        return int((self.secret * t + self.delta_[i]) % self.q_)
+
+    def ot_batch(self, t):
+        """
+        ot_batch. This function carries out all n OTs at once. In other words, this
+        function returns the vector z with z[i] = ot(i, t[i]) for every i.
+        If t is not of length n or contains an entry that is not 1 or -1 then this function
+        raises a value error.
+
+        :param t: the choice vector of the receiver party.
+        :rtype an array.
+
+        ::
+
+        >>> a = 10
+        >>> q = 11
+        >>> s = Sender(a, q)
+        >>> s.ot_batch([1, -1])
+        Traceback (most recent call last):
+        ...
+        ValueError: t must have length n
+        >>> s.ot_batch([2] * s.n)
+        Traceback (most recent call last):
+        ...
+        ValueError: t must be 1 or -1
+        >>> s.ot_batch([1.9] * s.n)
+        Traceback (most recent call last):
+        ...
+        ValueError: t must be 1 or -1
+        >>> t = [1, -1] * (s.n // 2) + [1] * (s.n % 2)
+        >>> [s.ot(i, t[i]) for i in range(s.n)] == list(s.ot_batch(t))
+        True
+        """
+
+        # We check t before converting it, as converting would truncate non-integer entries.
+        t = np.asarray(t)
+        if len(t) != self.n_:
+            raise ValueError("t must have length n")
+        if ((t != 1) & (t != -1)).any():
+            raise ValueError("t must be 1 or -1")
+
+        return self._ot_batch_unchecked(t.astype(self.dtype_))
+
+    def _ot_batch_unchecked(self, t):
+        """
+        _ot_batch_unchecked. This function is the same as ot_batch, but without any validation of t.
+        Here t must already be an array with the same dtype as delta.
+        """
+        # All operations are over Z_q.
+        return (self.secret * t + self.delta_) % self.q_
 
 
 class Receiver(Player):
@@ -209,30 +454,69 @@ class Receiver(Player):
         >>> b = 11
         >>> q = 13
         >>> r = Receiver(b, q)
-        >>> r.q == q and r.n == ceil(log(q,2)) + k
+        >>> r.q == q and r.n == int(q).bit_length() + k
         True
-        >>> len(r.t) == ceil(log(q, 2)) + k and len([x for x in r.t if x != 1 and x != -1]) == 0
+        >>> len(r.t) == int(q).bit_length() + k and len([x for x in r.t if x != 1 and x != -1]) == 0
         True
         """
 
         Player.__init__(self, b, q)
-        self.t_ = [sample_t() for x in range(self.n_)]
+        # We store t as a vector of bits, where a 0 bit represents 1 and a 1 bit represents -1.
+        # The signed version is only built when it is first needed.
+        self.t_bits_ = get_rng().integers(0, 2, size=self.n_, dtype=np.uint8)
+        self.t_ = None
 
     @property
     def t(self):
         """
         t. This function returns the t vector held by the receiver. Here t
-        is a list of entries of length `n` where each entry is either 1 or -1.
+        is an array of entries of length `n` where each entry is either 1 or -1.
 
         ::
         >>> b = 5
         >>> q = 11
         >>> r = Receiver(b, q)
-        >>> len(r.t) == ceil(log(q, 2)) + k and len([x for x in r.t if x != 1 and x != -1]) == 0
+        >>> len(r.t) == int(q).bit_length() + k and len([x for x in r.t if x != 1 and x != -1]) == 0
+        True
+        >>> all(r.t == 1 - 2 * r.t_bits.astype(int))
         True
         """
+        if self.t_ is None:
+            self.t_ = 1 - 2 * self.t_bits_.astype(self.dtype_)
         return self.t_
 
+    @property
+    def t_bits(self):
+        """
+        t_bits. This function returns the t vector held by the receiver as a vector of bits.
+        Here a 0 bit corresponds to an entry of 1 in t and a 1 bit corresponds to an entry of -1.
+
+        ::
+        >>> b = 5
+        >>> q = 11
+        >>> r = Receiver(b, q)
+        >>> r.t_bits.dtype == np.uint8 and len([x for x in r.t_bits if x != 0 and x != 1]) == 0
+        True
+        """
+        return self.t_bits_
+
+    def sample_v(self):
+        """
+        sample_v. This function returns (v, rnd), where v is a uniformly random vector over Z_q^n and
+        rnd is a uniformly random index into v. This is the randomness used by v: in particular,
+        v adjusts the entry v[rnd] so that <v, t> = b.
+
+        ::
+
+        >>> b = 5
+        >>> q = 2**16 + 1
+        >>> r = Receiver(b, q)
+        >>> v, rnd = r.sample_v()
+        >>> len(v) == r.n and 0 <= rnd < r.n
+        True
+        """
+        return sample_vector(self.q, self.n, self.dtype_), randrange(self.n)
+
     def v(self):
         """
         v. This function returns a vector, v, such that <v, t> = b.
@@ -247,22 +531,18 @@ class Receiver(Player):
         >>> q = 2**16 + 1
         >>> r = Receiver(b, q)
         >>> v = r.v()
-        >>> sum(map(lambda x, y : x * y, r.t, v)) % q == b
+        >>> int(r.t.dot(v)) % q == b
         True
         """
 
         # This function works by producing a random set of values,
-        # then appropriately adding or subtracting the excess to an element of the
-        # random set.
-        v = [randrange(self.q) for t in range(self.n)]
-        # Work out how far away from b we are.
-        tot = sum(map(lambda x, y: x * y, self.t, v)) % self.q
-        targ_b = (self.secret - tot) % self.q
-        # Adjust the random value.
-        rnd = randrange(self.n)
-        v[rnd] = v[rnd] + targ_b * self.t[rnd]
-        # This isn't separate for any good reason.
-        v[rnd] = v[rnd] % self.q
+        # then overwriting one randomly chosen element so that the constraint holds.
+        # Since t[rnd] is 1 or -1, it is its own inverse mod q.
+        v, rnd = self.sample_v()
+        # Work out the contribution of everything except the element we're replacing.
+        t_rnd = int(self.t[rnd])
+        rest = int(v.dot(self.t) - v[rnd] * t_rnd) % self.q
+        v[rnd] = ((self.secret - rest) * t_rnd) % self.q
         return v
 
 
@@ -296,14 +576,77 @@ def play(receiver, sender):
     if receiver.q != sender.q:
         raise ValueError("receiver and sender q don't match")
 
-    z = [sender.ot(i, receiver.t[i]) for i in range(sender.n)]
+    # Look everything up once. Note that t is valid by construction, so we skip the
+    # checks carried out by ot_batch.
+    t = receiver.t
+    delta = sender.delta_
+    a = sender.secret
+    q = sender.q_
+    if kernel_compiled and sender.dtype_ is np.int64:
+        v, rnd = receiver.sample_v()
+        p1, p2 = play_kernel(a, receiver.secret, q, delta, t, v, rnd)
+        return (int(p1), int(p2))
+
     v = receiver.v()
-    q = sender.q
-    p1 = -sum(map(lambda x, y: x * y, sender.delta, v)) % q
-    p2 = sum(map(lambda x, y: x * y, z, v)) % q
+    z = sender._ot_batch_unchecked(t)
+    # Each dot product is reduced exactly once.
+    p1 = int(-delta.dot(v)) % q
+    p2 = int(z.dot(v)) % q
     return (p1, p2)
 
 
+def play_one(a, b, q):
+    """
+    play_one. This function creates a new sender (holding a) and receiver (holding b) over Z_q and
+    runs the protocol between them, returning (p1, p2) such that p1 + p2 = a * b mod q.
+
+    ::
+
+    >>> q = (2**16) + 1
+    >>> a = randrange(q)
+    >>> b = randrange(q)
+    >>> sum(play_one(a, b, q)) % q == (a * b) % q
+    True
+    """
+    return play(Receiver(b, q), Sender(a, q))
+
+
+def reseed():
+    """
+    reseed. This function reseeds Sage's random number generator, and hence also the generator
+    returned by get_rng. This is used by play_many so that each worker process produces different
+    randomness.
+    """
+    set_random_seed()
+
+
+def play_many(triples, max_workers=None):
+    """
+    play_many. This function runs the protocol for each (a, b, q) in triples, returning a list containing
+    the (p1, p2) produced by each run, in the same order as triples. Each run is independent, so the
+    runs are distributed across max_workers processes (by default, one per core).
+
+    :param triples: an iterable of (a, b, q) triples.
+    :param max_workers: the number of processes to use.
+    :rtype a list of tuples.
+
+    ::
+
+    >>> q = (2**16) + 1
+    >>> triples = [(randrange(q), randrange(q), q) for _ in range(4)]
+    >>> results = play_many(triples, max_workers=2)
+    >>> all(sum(p) % q == (a * b) % q for (a, b, q), p in zip(triples, results))
+    True
+    """
+    triples = list(triples)
+    workers = max_workers or os.cpu_count() or 1
+    # A single run is short, so we send each worker several runs at a time: otherwise
+    # the cost of communicating with the workers outweighs the work itself.
+    chunksize = max(1, len(triples) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers, initializer=reseed) as executor:
+        return list(executor.map(play_one, *zip(*triples), chunksize=chunksize))
+
+
 if __name__ == "__main__":
     import doctest
 
@@ -0,0 +1,59 @@
+# cython: language_level=3
+"""
+A Cython version of play_kernel from mta.py, which runs the whole protocol in a single pass.
+
+This is optional: mta.py uses this if `from mta_core import play_kernel` succeeds, falling back to
+Numba and then NumPy otherwise. It can be built with `cythonize -i mta_core.pyx`.
+"""
+
+cimport cython
+from libc.stdint cimport int64_t
+
+
+cdef inline int64_t madd_mod(int64_t a, int64_t b, int64_t c, int64_t q) noexcept nogil:
+    """
+    madd_mod. This returns (a * b + c) mod q. The caller must make sure that a * b + c is non-negative.
+    """
+    return (a * b + c) % q
+
+
+cdef inline int64_t mod(int64_t x, int64_t q) noexcept nogil:
+    """
+    mod. This returns x mod q in the range [0, q), even if x is negative.
+    """
+    return ((x % q) + q) % q
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cpdef tuple play_kernel(int64_t a, int64_t b, int64_t q, const int64_t[::1] delta, const int64_t[::1] t,
+                        const int64_t[::1] v, Py_ssize_t rnd):
+    """
+    play_kernel. This function has the same behaviour as play_kernel in mta.py.
+    In other words, this function runs the whole protocol in a single pass, where v and rnd are
+    the values sampled by Receiver.sample_v before v[rnd] is adjusted. All inputs must satisfy
+    fits_int64(q, len(delta)).
+    """
+    cdef Py_ssize_t i
+    cdef Py_ssize_t n = delta.shape[0]
+    cdef int64_t z, diff
+    cdef int64_t tot = 0
+    cdef int64_t p1 = 0
+    cdef int64_t p2 = 0
+
+    with nogil:
+        for i in range(n):
+            # We add q so that the input to madd_mod is non-negative.
+            z = madd_mod(a, t[i], delta[i] + q, q)
+            tot += t[i] * v[i]
+            p1 += delta[i] * v[i]
+            p2 += z * v[i]
+
+        # Now work out what v[rnd] should have been (see Receiver.v) and correct for it.
+        diff = mod((b - (tot - t[rnd] * v[rnd])) * t[rnd], q) - v[rnd]
+        z = madd_mod(a, t[rnd], delta[rnd] + q, q)
+        p1 = mod(p1 % q + delta[rnd] * diff, q)
+        p2 = mod(p2 % q + z * diff, q)
+
+    return ((q - p1) % q, p2)